@@ -0,0 +1,24 @@
+import re
+import pandas as pd
+from textblob import TextBlob
+from textblob.en import sentiment as textblob_lexicon
+
+# Only the driver builds the lexicon, so Python workers never import TextBlob or NLTK.
+
+_WORD_PATTERN = re.compile(r"[\w']+")
+
+
+def build_lexicon():
+    """
+    Builds a sentiment lexicon from the words known to TextBlob.
+
+    Returns:
+        pd.DataFrame: The lowercase words with their TextBlob polarity and subjectivity.
+    """
+    words = sorted({word.lower() for word in textblob_lexicon.keys() if _WORD_PATTERN.fullmatch(word)})
+    sentiments = [TextBlob(word).sentiment for word in words]
+    return pd.DataFrame({
+        "key": words,
+        "polarity": [sentiment.polarity for sentiment in sentiments],
+        "subjectivity": [sentiment.subjectivity for sentiment in sentiments]
+    })
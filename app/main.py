@@ -1,16 +1,129 @@
 import os
 import configparser
+import threading
+import time
 import logging
 import smtplib
+from dataclasses import dataclass, field, replace
 from email.message import EmailMessage
+from functools import partial
+from typing import Optional
+from urllib.parse import parse_qsl, urlparse
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import explode, split, col, from_json, udf
+from pyspark.sql.functions import broadcast, coalesce, col, from_json, length, lit, lower, regexp_replace
 from pyspark.sql.types import StringType, StructType, StructField
-from textblob import TextBlob
-import preprocessor as p
+from pyspark.sql.utils import StreamingQueryException
+import psycopg2
+from psycopg2.extensions import make_dsn, parse_dsn
+from app import postgres_sink
+from app.lexicon import build_lexicon
+from app.text_processing import WORDS_SCHEMA, tokenize
 
 logging.basicConfig(filename='app.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+
+@dataclass(frozen=True)
+class RunConfig:
+    """
+    The settings of the application, frozen at start-up so that closures only carry primitives.
+    """
+    kafka_servers: str
+    kafka_topic: str
+    kafka_max_offsets_per_trigger: int
+    kafka_min_partitions: Optional[int]
+    kafka_fetch_min_bytes: int
+    kafka_fetch_max_wait_ms: int
+    kafka_max_partition_fetch_bytes: int
+    kafka_poll_timeout_ms: Optional[int]
+    postgres_host: str
+    postgres_port: int
+    postgres_dbname: str
+    postgres_user: str
+    postgres_password: Optional[str] = field(repr=False)
+    postgres_options: tuple
+    postgres_batchsize: int
+    postgres_writers: int
+    stream_trigger: str
+    stream_checkpoint_location: str
+    stream_schema_evolution: bool
+    stream_max_retry_backoff: int
+    stream_max_retries: int
+    spark_arrow_max_records_per_batch: int
+    spark_executor_pyspark_memory: Optional[str]
+    spark_udf_parallelism: Optional[int]
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Reads the settings from the given configuration.
+
+        The PostgreSQL password is read from the POSTGRES_PASSWORD environment variable. Query
+        parameters of the PostgreSQL URL are passed to psycopg2, so they must be libpq connection
+        options such as sslmode.
+
+        Parameters:
+            config (ConfigParser): The configuration read from 'config.ini'.
+
+        Returns:
+            RunConfig: The settings.
+
+        Raises:
+            ValueError: If the PostgreSQL URL has a query parameter that is not a libpq connection option.
+        """
+        kafka = config['kafka']
+        postgres = config['postgres']
+        stream = config['stream']
+        spark = config['spark']
+        jdbc_url = postgres['url']
+        url = urlparse(jdbc_url[len("jdbc:"):] if jdbc_url.startswith("jdbc:") else jdbc_url)
+        postgres_options = tuple(parse_qsl(url.query))
+        try:
+            parse_dsn(make_dsn(**dict(postgres_options)))
+        except psycopg2.ProgrammingError as e:
+            raise ValueError(f"Unsupported option in PostgreSQL URL {jdbc_url}: {e}") from e
+        return cls(
+            kafka_servers=kafka['servers'],
+            kafka_topic=kafka['topic'],
+            kafka_max_offsets_per_trigger=kafka.getint('max_offsets_per_trigger', 200000),
+            kafka_min_partitions=kafka.getint('min_partitions', None),
+            kafka_fetch_min_bytes=kafka.getint('fetch_min_bytes', 1048576),
+            kafka_fetch_max_wait_ms=kafka.getint('fetch_max_wait_ms', 100),
+            kafka_max_partition_fetch_bytes=kafka.getint('max_partition_fetch_bytes', 10485760),
+            kafka_poll_timeout_ms=kafka.getint('poll_timeout_ms', None),
+            postgres_host=url.hostname,
+            postgres_port=url.port or 5432,
+            postgres_dbname=url.path.lstrip("/"),
+            postgres_user=postgres['user'],
+            postgres_password=os.environ.get('POSTGRES_PASSWORD'),
+            postgres_options=postgres_options,
+            postgres_batchsize=postgres.getint('batchsize', 10000),
+            postgres_writers=postgres.getint('writers', 4),
+            stream_trigger=stream.get('trigger', '2 seconds'),
+            stream_checkpoint_location=stream.get('checkpoint_location', 'checkpoints'),
+            stream_schema_evolution=stream.getboolean('schema_evolution', False),
+            stream_max_retry_backoff=stream.getint('max_retry_backoff', 60),
+            stream_max_retries=stream.getint('max_retries', 5),
+            spark_arrow_max_records_per_batch=spark.getint('arrow_max_records_per_batch', 5000),
+            spark_executor_pyspark_memory=spark.get('executor_pyspark_memory', None),
+            spark_udf_parallelism=spark.getint('udf_parallelism', None))
+
+    def postgres_connection_params(self):
+        """
+        Returns the psycopg2 connection parameters.
+
+        Returns:
+            dict: The psycopg2 connection parameters.
+        """
+        return {
+            "host": self.postgres_host,
+            "port": self.postgres_port,
+            "dbname": self.postgres_dbname,
+            "user": self.postgres_user,
+            "password": self.postgres_password,
+            **dict(self.postgres_options)
+        }
+
+
 class TwitterSentimentAnalysis:
     """
     A class to perform Twitter sentiment analysis.
@@ -19,12 +132,19 @@ class TwitterSentimentAnalysis:
         """
         Constructs all the necessary attributes for the TwitterSentimentAnalysis object.
 
-        Reads configuration from 'config.ini' file and creates Spark session. 
+        Reads configuration from 'config.ini' file, freezes the settings and creates Spark session. 
         Defines the schema for incoming data.
         """
         self.config = self.read_config('config.ini')
+        try:
+            self.run_config = RunConfig.from_config(self.config)
+        except Exception as e:
+            self.handle_error(f"Invalid configuration: {e}")
         self.spark = self.create_spark_session()
         self.mySchema = StructType([StructField("text", StringType(), True)])
+        self._query_id = None
+        self._query_started = threading.Event()
+        self._conn = None
 
     def read_config(self, file_path):
         """
@@ -44,11 +164,30 @@ class TwitterSentimentAnalysis:
         """
         Creates a SparkSession.
 
+        The Kafka minimum partitions and the UDF parallelism default to twice the default parallelism
+        in run_config when they are not configured. Shuffle partitions are set to the UDF parallelism.
+
         Returns:
             spark: A SparkSession object.
         """
         try:
-            spark = SparkSession.builder.appName("TwitterSentimentAnalysis").getOrCreate()
+            builder = SparkSession.builder \
+                .appName("TwitterSentimentAnalysis") \
+                .config("spark.sql.execution.arrow.pyspark.enabled", "true") \
+                .config("spark.sql.execution.arrow.maxRecordsPerBatch",
+                        self.run_config.spark_arrow_max_records_per_batch) \
+                .config("spark.python.worker.reuse", "true") \
+                .config("spark.sql.streaming.kafka.useDeprecatedOffsetFetching", "false")
+            if self.run_config.spark_executor_pyspark_memory:
+                builder = builder.config("spark.executor.pyspark.memory",
+                                         self.run_config.spark_executor_pyspark_memory)
+            spark = builder.getOrCreate()
+            default_parallelism = spark.sparkContext.defaultParallelism * 2
+            self.run_config = replace(
+                self.run_config,
+                kafka_min_partitions=self.run_config.kafka_min_partitions or default_parallelism,
+                spark_udf_parallelism=self.run_config.spark_udf_parallelism or default_parallelism)
+            spark.conf.set("spark.sql.shuffle.partitions", self.run_config.spark_udf_parallelism)
         except Exception as e:
             self.handle_error(f"Failed to create Spark session: {e}")
         return spark
@@ -81,146 +220,190 @@ class TwitterSentimentAnalysis:
 
     def handle_error(self, error_message):
         """
-        Handles the given error by logging it and sending an alert email.
+        Handles the given error by logging it, sending an alert email and raising it.
 
         Parameters:
             error_message (str): The error message to handle.
+
+        Raises:
+            RuntimeError: Always, with the given error message.
         """
         logging.error(error_message)
         self.send_alert_email(error_message)
-        exit(1)
+        raise RuntimeError(error_message)
 
-    def clean_text(self, text):
+    def sentiment_analysis(self, tweets, lexicon):
         """
-        Cleans the given text by removing URLs, mentions, hashtags and reserved words.
+        Splits the given DataFrame of tweets into words and classifies them based on their polarity and subjectivity.
 
-        Parameters:
-            text (str): The text to clean.
-
-        Returns:
-            str: The cleaned text.
-        """
-        return p.clean(text)
-
-    def preprocessing(self, df):
-        """
-        Preprocesses the given DataFrame by cleaning and splitting the text into words.
+        Missing, very short and retweeted tweets are dropped before any text is cleaned, and the
+        rest are spread over as many partitions as the configured UDF parallelism, unless the Kafka
+        source already reads them into as many. Words are scored by a broadcast join against the
+        lexicon, so scoring stays in the JVM.
 
         Parameters:
-            df (DataFrame): The DataFrame to preprocess.
+            tweets (DataFrame): The DataFrame of tweets to analyze.
+            lexicon (DataFrame): The lexicon returned by build_lexicon, as a Spark DataFrame.
 
         Returns:
-            DataFrame: The preprocessed DataFrame.
+            DataFrame: The classified DataFrame of words.
         """
-        clean_text_udf = udf(self.clean_text, StringType())
-        words = df.select(explode(split(clean_text_udf(df.text), " ")).alias("word"))
-        words = words.na.replace('', None)
-        words = words.na.drop()
-        return words
+        tweets = tweets.where(col("text").isNotNull() & (length(col("text")) > 2) & ~col("text").rlike("^RT "))
+        if self.run_config.spark_udf_parallelism != self.run_config.kafka_min_partitions:
+            # Shuffling into the number of partitions the source already has would not add any parallelism.
+            tweets = tweets.repartition(self.run_config.spark_udf_parallelism)
+        words = tweets.mapInPandas(tokenize, schema=WORDS_SCHEMA)
+        words = words.withColumn("key", regexp_replace(lower(col("word")), "(?U)[^\\w']", ""))
+        words = words.join(broadcast(lexicon), on="key", how="left")
+        return words.select(
+            "word",
+            coalesce(col("polarity"), lit(0.0)).alias("polarity"),
+            coalesce(col("subjectivity"), lit(0.0)).alias("subjectivity"))
 
-    def polarity_detection(self, text):
+    def handle_schema_evolution(self, current_df, expected_schema):
         """
-        Detects the polarity of the given text using TextBlob.
+        Handles schema evolution by matching the current DataFrame's schema to the expected schema.
 
         Parameters:
-            text (str): The text to analyze.
+            current_df (DataFrame): The current DataFrame.
+            expected_schema (StructType): The expected schema.
 
         Returns:
-            float: The polarity of the text.
+            DataFrame: The DataFrame with the matched schema.
         """
-        return TextBlob(text).sentiment.polarity
+        current_columns = set(current_df.columns)
+        expected_columns = set([field.name for field in expected_schema.fields])
+        common_columns = current_columns.intersection(expected_columns)
+        return current_df.select([col(column) for column in common_columns])
 
-    def subjectivity_detection(self, text):
+    def _get_connection(self):
         """
-        Detects the subjectivity of the given text using TextBlob.
+        Returns the driver's PostgreSQL connection, reconnecting if it was closed since its last use.
 
-        Parameters:
-            text (str): The text to analyze.
+        The driver keeps its own connection, separate from the executors' pools.
 
         Returns:
-            float: The subjectivity of the text.
+            connection: The psycopg2 connection.
         """
-        return TextBlob(text).sentiment.subjectivity
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg2.connect(**self.run_config.postgres_connection_params())
+        return self._conn
 
-    def text_classification(self, words):
+    def _write_batch(self, df, epoch_id):
         """
-        Classifies the given DataFrame of words based on their polarity and subjectivity.
+        Writes a micro-batch of classified words to PostgreSQL unless it was already written.
 
-        Parameters:
-            words (DataFrame): The DataFrame to classify.
-
-        Returns:
-            DataFrame: The classified DataFrame.
-        """
-        polarity_detection_udf = udf(self.polarity_detection, StringType())
-        subjectivity_detection_udf = udf(self.subjectivity_detection, StringType())
-        words = words.withColumn("polarity", polarity_detection_udf("word"))
-        words = words.withColumn("subjectivity", subjectivity_detection_udf("word"))
-        return words
-
-    def handle_schema_evolution(self, current_df, expected_schema):
-        """
-        Handles schema evolution by matching the current DataFrame's schema to the expected schema.
+        The partitions are staged in sentiment_analysis_staging, then moved into sentiment_analysis
+        in the same transaction that records the micro-batch in sentiment_analysis_batches. A
+        micro-batch that Spark replays after a restart from its checkpoint is therefore either
+        skipped or written from scratch. Micro-batches are keyed by query id as well, since batch
+        ids restart from 0 when the checkpoint is replaced.
 
         Parameters:
-            current_df (DataFrame): The current DataFrame.
-            expected_schema (StructType): The expected schema.
-
-        Returns:
-            DataFrame: The DataFrame with the matched schema.
+            df (DataFrame): The micro-batch to write.
+            epoch_id (int): The id of the micro-batch.
         """
-        current_columns = set(current_df.columns)
-        expected_columns = set([field.name for field in expected_schema.fields])
-        common_columns = current_columns.intersection(expected_columns)
-        return current_df.select([col(column) for column in common_columns])
+        self._query_started.wait()
+        query_id = self._query_id
+        conn = self._get_connection()
+        try:
+            if postgres_sink.batch_written(conn, query_id, epoch_id):
+                conn.rollback()
+                logging.info(f"Skipping micro-batch {epoch_id} of query {query_id}, it was already written")
+                return
+            postgres_sink.clear_staged_batch(conn, query_id, epoch_id)
+            conn.commit()
+            # repartition rather than coalesce, which would also shrink the upstream cleaning stage
+            # to the number of writers.
+            df.repartition(self.run_config.postgres_writers).foreachPartition(partial(
+                postgres_sink.copy_partition,
+                connection_params=self.run_config.postgres_connection_params(),
+                batchsize=self.run_config.postgres_batchsize,
+                query_id=query_id,
+                batch_id=epoch_id))
+            postgres_sink.publish_batch(conn, query_id, epoch_id)
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
 
     def run(self):
         """
         Runs the Twitter sentiment analysis application.
+
+        The streaming query is restarted with exponential backoff whenever it fails, with an alert
+        email for every failure. The application gives up after too many failures in a row without
+        any data written in between.
         """
-        kafka_servers = self.config['kafka']['servers']
-        kafka_topic = self.config['kafka']['topic']
-        postgres_url = self.config['postgres']['url']
-        postgres_properties = {
-            "user": self.config['postgres']['user'],
-            "password": os.environ.get('POSTGRES_PASSWORD'),
-            "driver": "org.postgresql.Driver"
-        }
+        cfg = self.run_config
 
         try:
-            raw_tweets = self.spark \
+            reader = self.spark \
                 .readStream \
                 .format("kafka") \
-                .option("kafka.bootstrap.servers", kafka_servers) \
-                .option("subscribe", kafka_topic) \
-                .load()
+                .option("kafka.bootstrap.servers", cfg.kafka_servers) \
+                .option("subscribe", cfg.kafka_topic) \
+                .option("maxOffsetsPerTrigger", cfg.kafka_max_offsets_per_trigger) \
+                .option("minPartitions", cfg.kafka_min_partitions) \
+                .option("kafka.fetch.min.bytes", cfg.kafka_fetch_min_bytes) \
+                .option("kafka.fetch.max.wait.ms", cfg.kafka_fetch_max_wait_ms) \
+                .option("kafka.max.partition.fetch.bytes", cfg.kafka_max_partition_fetch_bytes)
+            if cfg.kafka_poll_timeout_ms is not None:
+                reader = reader.option("kafkaConsumer.pollTimeoutMs", cfg.kafka_poll_timeout_ms)
+            raw_tweets = reader.load()
         except Exception as e:
             self.handle_error(f"Error connecting to Kafka: {e}")
 
         try:
             tweet_values = raw_tweets.select(from_json(col("value").cast("string"), self.mySchema).alias("parsed"))
-            tweets = tweet_values.select("parsed.*")
-            tweets = self.handle_schema_evolution(tweets, self.mySchema)
+            if cfg.stream_schema_evolution:
+                tweets = tweet_values.select("parsed.*")
+                tweets = self.handle_schema_evolution(tweets, self.mySchema)
+            else:
+                tweets = tweet_values.select(col("parsed.text").alias("text"))
         except Exception as e:
             self.handle_error(f"Error parsing Kafka stream: {e}")
 
         try:
-            words = self.preprocessing(tweets)
-            words = self.text_classification(words)
+            lexicon = self.spark.createDataFrame(build_lexicon()).cache()
+            words = self.sentiment_analysis(tweets, lexicon)
         except Exception as e:
             self.handle_error(f"Error processing or classifying text: {e}")
 
-        try:
-            words.writeStream \
-                .foreachBatch(lambda df, epoch_id: df.write.jdbc(
-                    url=postgres_url,
-                    table="sentiment_analysis",
-                    mode="append",
-                    properties=postgres_properties)) \
-                .start() \
-                .awaitTermination()
-        except Exception as e:
-            self.handle_error(f"Error writing to PostgreSQL database: {e}")
+        backoff = 1
+        failures = 0
+        while True:
+            self._query_started.clear()
+            try:
+                query = words.writeStream \
+                    .foreachBatch(self._write_batch) \
+                    .trigger(processingTime=cfg.stream_trigger) \
+                    .option("checkpointLocation", cfg.stream_checkpoint_location) \
+                    .start()
+            except Exception as e:
+                self.handle_error(f"Error starting the streaming query: {e}")
+            self._query_id = query.id
+            self._query_started.set()
+
+            try:
+                query.awaitTermination()
+                return
+            except StreamingQueryException as e:
+                if any(progress["numInputRows"] > 0 for progress in query.recentProgress):
+                    # The query wrote data since it last (re)started, so this is a new failure.
+                    backoff = 1
+                    failures = 0
+                failures += 1
+                if failures > cfg.stream_max_retries:
+                    self.handle_error(f"Streaming query failed {failures} times in a row, giving up: {e}")
+                # The query resumes from its checkpoint, so a transient Kafka or PostgreSQL
+                # failure only delays the micro-batches in flight.
+                error_message = f"Streaming query failed, restarting in {backoff} seconds: {e}"
+                logging.error(error_message)
+                self.send_alert_email(error_message)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, cfg.stream_max_retry_backoff)
 
 if __name__ == "__main__":
     TwitterSentimentAnalysis().run()
@@ -0,0 +1,150 @@
+import io
+import csv
+import threading
+from itertools import islice
+import psycopg2
+import psycopg2.pool
+from pyspark import TaskContext
+
+_COPY_SQL = ("COPY sentiment_analysis_staging (query_id, batch_id, partition_id, word, polarity, subjectivity) "
+             "FROM STDIN WITH (FORMAT CSV)")
+_LOCK_PARTITION_SQL = "SELECT pg_advisory_xact_lock(hashtext(%s), %s)"
+_CLEAR_PARTITION_SQL = ("DELETE FROM sentiment_analysis_staging "
+                        "WHERE query_id = %s AND batch_id = %s AND partition_id = %s")
+_BATCH_WRITTEN_SQL = "SELECT 1 FROM sentiment_analysis_batches WHERE query_id = %s AND batch_id = %s"
+_CLEAR_STAGED_SQL = "DELETE FROM sentiment_analysis_staging WHERE query_id = %s AND batch_id = %s"
+_PUBLISH_STAGED_SQL = ("INSERT INTO sentiment_analysis (word, polarity, subjectivity) "
+                       "SELECT word, polarity, subjectivity FROM sentiment_analysis_staging "
+                       "WHERE query_id = %s AND batch_id = %s")
+_RECORD_BATCH_SQL = "INSERT INTO sentiment_analysis_batches (query_id, batch_id) VALUES (%s, %s)"
+
+# One pool per Python worker, reused by every micro-batch the worker writes. This module must be
+# importable on the executors (shipped with --py-files) so that tasks refer to it instead of
+# carrying their own copy of these globals.
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(connection_params):
+    """
+    Returns this worker's PostgreSQL connection pool, creating it on first use.
+
+    Parameters:
+        connection_params (dict): The psycopg2 connection parameters.
+
+    Returns:
+        ThreadedConnectionPool: The connection pool.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = psycopg2.pool.ThreadedConnectionPool(1, 1, **connection_params)
+    return _pool
+
+
+def _get_connection(pool):
+    """
+    Takes a live connection from the given pool, replacing one closed since its last use.
+
+    Parameters:
+        pool (ThreadedConnectionPool): The connection pool.
+
+    Returns:
+        connection: The psycopg2 connection.
+    """
+    conn = pool.getconn()
+    if conn.closed:
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+
+def copy_partition(rows, connection_params, batchsize, query_id, batch_id):
+    """
+    Stages a partition of classified words in PostgreSQL with COPY FROM STDIN.
+
+    Runs on the executors, with a connection from the worker's pool. The rows only reach
+    sentiment_analysis once the driver publishes the whole micro-batch. Rows staged by an earlier
+    attempt at the same partition, such as a task that committed and then failed or a speculative
+    copy of it, are deleted in the same transaction as the COPY.
+
+    Parameters:
+        rows (iterator): The rows of the partition.
+        connection_params (dict): The psycopg2 connection parameters.
+        batchsize (int): The maximum number of rows sent per COPY.
+        query_id (str): The id of the streaming query, which persists across restarts from its checkpoint.
+        batch_id (int): The id of the micro-batch.
+    """
+    partition_id = TaskContext.get().partitionId()
+    pool = _get_pool(connection_params)
+    conn = _get_connection(pool)
+    try:
+        with conn.cursor() as cur:
+            # Serializes concurrent attempts at the partition, so the later one sees and deletes
+            # the rows the earlier one committed.
+            cur.execute(_LOCK_PARTITION_SQL, (f"{query_id}:{batch_id}", partition_id))
+            cur.execute(_CLEAR_PARTITION_SQL, (query_id, batch_id, partition_id))
+            while True:
+                batch = list(islice(rows, batchsize))
+                if not batch:
+                    break
+                buf = io.StringIO()
+                csv.writer(buf).writerows(
+                    (query_id, batch_id, partition_id, row.word, row.polarity, row.subjectivity) for row in batch)
+                buf.seek(0)
+                cur.copy_expert(_COPY_SQL, buf)
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
+
+
+def batch_written(conn, query_id, batch_id):
+    """
+    Checks whether the given micro-batch of the given query was already published.
+
+    Parameters:
+        conn (connection): The driver's psycopg2 connection.
+        query_id (str): The id of the streaming query.
+        batch_id (int): The id of the micro-batch.
+
+    Returns:
+        bool: True if the micro-batch was already published.
+    """
+    with conn.cursor() as cur:
+        cur.execute(_BATCH_WRITTEN_SQL, (query_id, batch_id))
+        return cur.fetchone() is not None
+
+
+def clear_staged_batch(conn, query_id, batch_id):
+    """
+    Deletes the rows an earlier, failed attempt at the given micro-batch left staged, without committing.
+
+    Parameters:
+        conn (connection): The driver's psycopg2 connection.
+        query_id (str): The id of the streaming query.
+        batch_id (int): The id of the micro-batch.
+    """
+    with conn.cursor() as cur:
+        cur.execute(_CLEAR_STAGED_SQL, (query_id, batch_id))
+
+
+def publish_batch(conn, query_id, batch_id):
+    """
+    Moves the staged rows of the given micro-batch into sentiment_analysis and records the
+    micro-batch as published, without committing.
+
+    Committing the connection afterwards makes the rows and the record visible together.
+
+    Parameters:
+        conn (connection): The driver's psycopg2 connection.
+        query_id (str): The id of the streaming query.
+        batch_id (int): The id of the micro-batch.
+    """
+    with conn.cursor() as cur:
+        cur.execute(_PUBLISH_STAGED_SQL, (query_id, batch_id))
+        cur.execute(_CLEAR_STAGED_SQL, (query_id, batch_id))
+        cur.execute(_RECORD_BATCH_SQL, (query_id, batch_id))
@@ -0,0 +1,37 @@
+import pandas as pd
+import preprocessor as p
+
+# Build tweet-preprocessor's compiled patterns at import. Executors import this module when they
+# unpickle tokenize, so the warmup runs once on every Python worker.
+p.clean("warmup #x http://y")
+
+
+def clean_text(text):
+    """
+    Cleans the given text by removing URLs, mentions, hashtags and reserved words.
+
+    Parameters:
+        text (str): The text to clean.
+
+    Returns:
+        str: The cleaned text.
+    """
+    return p.clean(text)
+
+
+WORDS_SCHEMA = "word string"
+
+
+def tokenize(batches):
+    """
+    Cleans batches of tweets and splits them into their non-empty words, for use with mapInPandas.
+
+    Parameters:
+        batches (iterator): The pd.DataFrame batches of tweets.
+
+    Yields:
+        pd.DataFrame: The WORDS_SCHEMA batches of words.
+    """
+    for tweets in batches:
+        words = tweets["text"].map(lambda text: clean_text(text).split()).explode().dropna()
+        yield pd.DataFrame({"word": words[words != ""].reset_index(drop=True)})
@@ -1,6 +1,23 @@
 import unittest
+import configparser
+from dataclasses import replace
 from unittest.mock import patch, MagicMock
-from app.main import TwitterSentimentAnalysis
+import pandas as pd
+from textblob import TextBlob
+from pyspark.sql import Row
+from pyspark.sql.utils import StreamingQueryException
+from app import postgres_sink
+from app.main import RunConfig, TwitterSentimentAnalysis
+from app.lexicon import build_lexicon
+from app.text_processing import clean_text, tokenize
+
+class QueryFailure(StreamingQueryException):
+    # StreamingQueryException's constructor differs between PySpark versions
+    def __init__(self):
+        Exception.__init__(self, "boom")
+
+    def __str__(self):
+        return "boom"
 
 class TestTwitterSentimentAnalysis(unittest.TestCase):
     
@@ -13,10 +30,147 @@ class TestTwitterSentimentAnalysis(unittest.TestCase):
         test_text = "Hello #world http://test.com"
         expected_output = "Hello world"
         # Run the method with the test case
-        output = self.tsa.clean_text(test_text)
+        output = clean_text(test_text)
         # Assert that the output is as expected
         self.assertEqual(output, expected_output)
 
+    def test_build_lexicon(self):
+        # The lexicon should hold unique lowercase words scored the same way TextBlob does
+        lexicon = build_lexicon().set_index("key")
+        self.assertTrue(lexicon.index.is_unique)
+        for word in ["good", "terrible"]:
+            sentiment = TextBlob(word).sentiment
+            self.assertAlmostEqual(lexicon.loc[word, "polarity"], sentiment.polarity)
+            self.assertAlmostEqual(lexicon.loc[word, "subjectivity"], sentiment.subjectivity)
+
+    def test_tokenize(self):
+        # Cleaned tweets should be split into their non-empty words
+        tweets = pd.DataFrame({"text": ["Hello  #world http://test.com", ""]})
+        words = pd.concat(tokenize(iter([tweets])))
+        self.assertEqual(list(words.word), ["Hello"])
+
+    def test_sentiment_analysis(self):
+        # Words should be matched to the lexicon regardless of case and punctuation,
+        # and words missing from it should score 0.0
+        tweets = self.tsa.spark.createDataFrame([("Good zzzq bad!",)], "text string")
+        lexicon = self.tsa.spark.createDataFrame(pd.DataFrame({
+            "key": ["good", "bad"],
+            "polarity": [0.7, 0.4],
+            "subjectivity": [0.6, 0.5]
+        }))
+        output = self.tsa.sentiment_analysis(tweets, lexicon).collect()
+        scores = {row.word: (row.polarity, row.subjectivity) for row in output}
+        self.assertEqual(scores, {"Good": (0.7, 0.6), "zzzq": (0.0, 0.0), "bad!": (0.4, 0.5)})
+
+    @patch('app.main.psycopg2.connect')
+    def test_write_batch_skips_written_batch(self, mock_connect):
+        # A micro-batch already recorded for this query should not be written again
+        mock_conn = mock_connect.return_value
+        mock_conn.closed = 0
+        mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+        mock_cursor.fetchone.return_value = (1,)
+        mock_df = MagicMock()
+        self.tsa._query_id = "query"
+        self.tsa._query_started.set()
+        self.tsa._write_batch(mock_df, 7)
+        mock_cursor.execute.assert_called_once()
+        self.assertEqual(mock_cursor.execute.call_args[0][1], ("query", 7))
+        self.assertEqual(mock_df.method_calls, [])
+        mock_conn.commit.assert_not_called()
+        # The driver's connection should be kept for the next micro-batch
+        self.tsa._write_batch(mock_df, 8)
+        mock_connect.assert_called_once()
+        mock_conn.close.assert_not_called()
+
+    def _config(self, url):
+        # A configuration with the given PostgreSQL URL and defaults for everything else
+        config = configparser.ConfigParser()
+        config.read_dict({
+            "kafka": {"servers": "localhost:9092", "topic": "tweets"},
+            "postgres": {"url": url, "user": "postgres"},
+            "spark": {},
+            "stream": {}
+        })
+        return config
+
+    def test_run_config_from_config(self):
+        # The JDBC URL should be split into psycopg2 parameters, keeping its libpq options
+        run_config = RunConfig.from_config(self._config("jdbc:postgresql://db.example.com/tweets?sslmode=require"))
+        params = run_config.postgres_connection_params()
+        self.assertEqual(params["host"], "db.example.com")
+        self.assertEqual(params["port"], 5432)
+        self.assertEqual(params["dbname"], "tweets")
+        self.assertEqual(params["sslmode"], "require")
+        self.assertIsNone(run_config.kafka_poll_timeout_ms)
+        run_config = RunConfig.from_config(self._config("postgresql://localhost:6543/tweets"))
+        self.assertEqual(run_config.postgres_port, 6543)
+
+    def test_run_config_rejects_jdbc_only_options(self):
+        # Options of the JDBC driver that libpq does not know should be rejected
+        with self.assertRaises(ValueError):
+            RunConfig.from_config(self._config("jdbc:postgresql://localhost/tweets?reWriteBatchedInserts=true"))
+
+    @patch('app.postgres_sink.TaskContext')
+    @patch('app.postgres_sink._get_pool')
+    def test_copy_partition_replaces_staged_partition(self, mock_get_pool, mock_task_context):
+        # Rows staged by an earlier attempt at the partition should be deleted before the COPY,
+        # in the same transaction
+        mock_task_context.get.return_value.partitionId.return_value = 3
+        mock_conn = mock_get_pool.return_value.getconn.return_value
+        mock_conn.closed = 0
+        mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+        rows = iter([Row(word="good", polarity=0.7, subjectivity=0.6)])
+        postgres_sink.copy_partition(rows, {}, 10, "query", 7)
+        self.assertEqual(mock_cursor.execute.call_args_list[1][0],
+                         (postgres_sink._CLEAR_PARTITION_SQL, ("query", 7, 3)))
+        copied = mock_cursor.copy_expert.call_args[0][1].getvalue()
+        self.assertEqual(copied, "query,7,3,good,0.7,0.6\r\n")
+        mock_conn.commit.assert_called_once()
+
+    def _run_with_queries(self, queries, mock_time, **run_config):
+        # Run the application against mock streaming queries, returned in turn by each start()
+        self.tsa.run_config = replace(self.tsa.run_config, **run_config)
+        self.tsa.spark = MagicMock()
+        mock_words = MagicMock()
+        mock_words.writeStream.foreachBatch.return_value.trigger.return_value \
+            .option.return_value.start.side_effect = queries
+        with patch('app.main.build_lexicon'), \
+                patch.object(self.tsa, 'sentiment_analysis', return_value=mock_words), \
+                patch.object(self.tsa, 'send_alert_email') as mock_send_alert_email:
+            try:
+                self.tsa.run()
+            finally:
+                self.sleeps = [call[0][0] for call in mock_time.sleep.call_args_list]
+                self.alerts = mock_send_alert_email.call_count
+
+    def _mock_query(self, fails=True, input_rows=0):
+        # A streaming query that fails, or terminates normally, after reading the given input rows
+        query = MagicMock()
+        query.recentProgress = [{"numInputRows": input_rows}]
+        if fails:
+            query.awaitTermination.side_effect = QueryFailure()
+        return query
+
+    @patch('app.main.time')
+    def test_run_gives_up_after_max_retries(self, mock_time):
+        # The wait between restarts should double up to max_retry_backoff, and every failure should
+        # be alerted until the application gives up
+        queries = [self._mock_query() for _ in range(5)]
+        with self.assertRaises(RuntimeError):
+            self._run_with_queries(queries, mock_time, stream_max_retries=4, stream_max_retry_backoff=3)
+        self.assertEqual(self.sleeps, [1, 2, 3, 3])
+        self.assertEqual(self.alerts, 5)
+
+    @patch('app.main.time')
+    def test_run_resets_backoff_after_progress(self, mock_time):
+        # A query that read input since its last restart should start the backoff and the failure
+        # count over
+        queries = [self._mock_query(), self._mock_query(), self._mock_query(input_rows=10),
+                   self._mock_query(), self._mock_query(fails=False)]
+        self._run_with_queries(queries, mock_time, stream_max_retries=2, stream_max_retry_backoff=60)
+        self.assertEqual(self.sleeps, [1, 2, 1, 2])
+        self.assertEqual(self.alerts, 4)
+
     @patch('your_script.TwitterSentimentAnalysis.get_kafka_stream')
     def test_run(self, mock_get_kafka_stream):
         # Create a mock Spark DataFrame